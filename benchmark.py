@@ -34,6 +34,7 @@ def run_benchmark():
     print("📊 Teste 1: Modo PARALELO (10 workers) + Rate Limiting Adaptativo")
     print("-" * 70)
     
+    etl_parallel = None
     try:
         etl_parallel = ChatwootETL(
             start_date=start_date.strftime('%Y-%m-%d'),
@@ -67,6 +68,9 @@ def run_benchmark():
             print("❌ Falha ao carregar inbox map")
     except Exception as e:
         print(f"❌ Erro: {str(e)}")
+    finally:
+        if etl_parallel is not None:
+            etl_parallel.close()
     
     print()
     
@@ -74,6 +78,7 @@ def run_benchmark():
     print("📊 Teste 2: Modo SEQUENCIAL (1 worker) + Rate Limiting Fixo")
     print("-" * 70)
     
+    etl_sequential = None
     try:
         etl_sequential = ChatwootETL(
             start_date=start_date.strftime('%Y-%m-%d'),
@@ -108,6 +113,9 @@ def run_benchmark():
             print("❌ Falha ao carregar inbox map")
     except Exception as e:
         print(f"❌ Erro: {str(e)}")
+    finally:
+        if etl_sequential is not None:
+            etl_sequential.close()
     
     print()
     
@@ -9,23 +9,212 @@ Data: 2025-12-05
 """
 
 import os
+import gzip
 import json
+import hashlib
+import logging
+import random
 import time
 import requests
+from requests.adapters import HTTPAdapter
 import argparse
 import sys
 import pickle
-from typing import List, Dict, Optional
+import shutil
+import threading
+from email.utils import parsedate_to_datetime
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from operator import attrgetter
+from typing import Dict, Iterable, Iterator, List, Optional, Union
 from datetime import datetime
 from pathlib import Path
 from tqdm import tqdm
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+# Intervalo mínimo entre redesenhos das barras de progresso (segundos)
+TQDM_MININTERVAL = 1.0
+
+# Buffer dos arquivos de saída: registros pequenos são acumulados e
+# gravados em blocos de 1 MB (menos syscalls em discos lentos/rede)
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Progresso do iter_messages via callback (faixa de 70% a 90%): uma
+# atualização a cada 1% das conversas (PROGRESS_STEPS atualizações)
+PROGRESS_STEPS = 100
+
+
+def _tqdm_miniters(total: Optional[int]) -> int:
+    """Iterações mínimas entre redesenhos (~200 atualizações por barra)"""
+    return max(1, (total or 0) // 200)
+
+try:
+    import orjson
+except ImportError:  # orjson é opcional: sem ele usa o json da stdlib
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard é opcional: sem ele a compactação usa gzip
+    zstandard = None
+
+
+@dataclass(slots=True)
+class Message:
+    """Mensagem exportada (um registro do arquivo de saída)"""
+    conversation_id: Optional[int]
+    customer_name: str
+    customer_email: str
+    channel_name: str
+    message_type: Union[int, str]
+    sender_name: str
+    content: Optional[str]
+    created_at_iso: Optional[str]
+    agent_email: Optional[str]
+    
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+# Schema das mensagens exportadas em Parquet
+# ('category' = coluna de baixa cardinalidade, gravada com dictionary encoding)
+PARQUET_FIELDS = (
+    ('conversation_id', 'int64'),
+    ('customer_name', 'category'),
+    ('customer_email', 'category'),
+    ('channel_name', 'category'),
+    ('message_type', 'category'),
+    ('sender_name', 'category'),
+    ('content', 'string'),
+    ('created_at_iso', 'string'),
+    ('agent_email', 'category'),
+)
+
+
+# Formatos de saída do run() e extensão do arquivo gerado (ver ChatwootETL.save)
+OUTPUT_EXTENSIONS = {
+    'json': '.json',
+    'jsonl': '.jsonl',
+    'parquet': '.parquet',
+}
+
+# Extensões de compactação aceitas por ChatwootETL.save (ex: .jsonl.zst)
+COMPRESSION_SUFFIXES = ('.gz', '.zst')
+
+
+def compression_suffix() -> str:
+    """Extensão de compactação disponível: .zst (zstandard) ou .gz (stdlib)"""
+    return '.zst' if zstandard is not None else '.gz'
+
+
+def _open_output(filename: str):
+    """
+    Abre o arquivo de saída para escrita binária, compactando conforme a
+    extensão: .gz (gzip nível 1, rápido) ou .zst (zstandard nível 3,
+    usando todos os núcleos)
+    """
+    suffix = Path(filename).suffix.lower()
+    if suffix == '.gz':
+        return gzip.open(filename, 'wb', compresslevel=1)
+    if suffix == '.zst':
+        if zstandard is None:
+            raise ImportError(
+                "❌ A compactação .zst requer o pacote zstandard.\n"
+                "Instale com: pip install zstandard (ou use .gz)"
+            )
+        raw = open(filename, 'wb', buffering=WRITE_BUFFER_SIZE)
+        return zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(raw)
+    return open(filename, 'wb', buffering=WRITE_BUFFER_SIZE)
+
+
+def _require_pyarrow():
+    """Importa o pyarrow sob demanda (dependência opcional da exportação Parquet)"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError(
+            "❌ A exportação em Parquet requer o pacote pyarrow.\n"
+            "Instale com: pip install pyarrow"
+        )
+    return pyarrow, pyarrow.parquet
+
+
+def _format_timestamps(values: List) -> List[Optional[str]]:
+    """
+    Converte uma coluna de timestamps Unix em strings ISO 8601
+    
+    Usa time.strftime/time.gmtime (struct_time em C, sem alocar um datetime
+    por valor). O horário é UTC, como indica o sufixo 'Z'.
+    Valores vazios viram None e valores inválidos são mantidos como texto.
+    """
+    strftime = time.strftime
+    gmtime = time.gmtime
+    fmt = '%Y-%m-%dT%H:%M:%SZ'
+    
+    formatted = []
+    append = formatted.append
+    for ts in values:
+        if not ts:
+            append(None)
+            continue
+        if not isinstance(ts, (int, float)):
+            append(str(ts))
+            continue
+        try:
+            append(strftime(fmt, gmtime(ts)))
+        except (TypeError, ValueError, OSError, OverflowError):
+            append(str(ts))
+    return formatted
+
+
+def _json_loads(content: bytes):
+    """Faz o parse de um corpo JSON (orjson se disponível)"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def _json_default(obj):
+    """Converte objetos não serializáveis pelo json da stdlib (ex: Message)"""
+    if isinstance(obj, Message):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _json_dumps(obj) -> bytes:
+    """Serializa um objeto para JSON em bytes UTF-8 (orjson se disponível)"""
+    if orjson is not None:
+        # orjson serializa dataclasses nativamente
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, default=_json_default).encode('utf-8')
+
+
+class ExtractionCancelled(Exception):
+    """Extração interrompida por ChatwootETL.cancel()"""
 
 
 class ChatwootETL:
     """Classe para gerenciar a extração de dados do Chatwoot"""
     
+    # Status tentados na listagem global de conversas, em ordem
+    STATUS_FILTERS = ('all', 'open', 'resolved', 'pending')
+    
+    # Endpoints com cache HTTP (ETag): inboxes e listagem de conversas.
+    # As mensagens de cada conversa não entram (um arquivo por conversa)
+    HTTP_CACHE_ENDPOINTS = ('/inboxes', '/conversations')
+    
+    # Combinações de filtros tentadas por inbox (inbox_id é acrescentado)
+    INBOX_PARAM_TEMPLATES = (
+        {'status': 'all'},
+        {'status': 'open'},
+        {'status': 'resolved'},
+        {},
+    )
+    
     def __init__(self, start_date: Optional[str] = None, end_date: Optional[str] = None, progress_callback=None):
         """
         Inicializa a classe com configurações do .env e datas de filtro
@@ -67,19 +256,98 @@ class ChatwootETL:
         }
         
         self.inbox_map = {}  # Mapa de inbox_id -> nome do canal
+        self._inbox_param_cache = {}  # inbox_id -> parâmetros que retornaram conversas
+        self._interned = {}  # Valores repetidos compartilhados entre mensagens (_intern)
         self.rate_limit_delay = 0.5  # Delay padrão entre requisições (500ms)
         self.max_retries = 3  # Número máximo de tentativas em caso de erro
+        self.max_backoff = 30  # Teto (segundos) do backoff entre tentativas
         self.cache_dir = Path('exports/.cache')  # Diretório para cache
         self.cache_ttl = 3600  # TTL do cache: 1 hora
+        self.http_cache = True  # Revalida respostas GET em cache via ETag/If-None-Match
+        self._http_cache_pruned = False  # Entradas expiradas já removidas nesta instância
+        self.checkpoint = False  # Grava páginas/mensagens já baixadas em checkpoint_dir
+        self.resume = False  # Retoma a partir do checkpoint de uma execução interrompida
+        self.checkpoint_dir = Path('exports/checkpoint')
+        self._checkpoint_lock = threading.Lock()
+        self._checkpoint_offsets = {}  # conversation_id -> posição (bytes) da entrada no checkpoint de mensagens
+        self.failed_conversations = []  # IDs das conversas cujas mensagens não puderam ser obtidas (iter_messages)
         self.max_workers = 10  # Número máximo de threads paralelas
         self.adaptive_rate_limit = True  # Usa rate limiting adaptativo
-        self.last_request_time = 0  # Para rate limiting adaptativo
+        self.output_format = 'json'  # Formato de saída do run(): 'json', 'jsonl' ou 'parquet'
+        self.max_request_rate = 20.0  # Teto do limitador adaptativo (req/s)
+        self.rate_limit_burst = 5  # Capacidade do token bucket (rajada)
+        self.rate_increase_after = 10  # Sucessos consecutivos antes de aumentar a taxa
+        
+        # Token bucket compartilhado entre as threads (rate limiting adaptativo)
+        self._rate_lock = threading.Lock()
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._retry_not_before = 0.0  # Instante (monotonic) liberado pelo último Retry-After
+        self._success_streak = 0  # Respostas bem-sucedidas desde o último ajuste/429
+        
+        # Pedido de cancelamento (cancel), verificado entre requisições e conversas
+        self._cancel_event = threading.Event()
+        
+        # Sessão HTTP persistente: reaproveita conexões TCP/TLS (keep-alive)
+        # entre requisições e entre as threads do pool
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self._pool_maxsize = 0
+        self._ensure_connection_pool()
         
         self._log(f"✅ Configuração carregada com sucesso!", 5)
         self._log(f"   API URL: {self.api_url}")
         self._log(f"   Account ID: {self.account_id}")
         if self.start_date:
             self._log(f"   Início: {self.start_date}")
+
+    def _ensure_connection_pool(self):
+        """
+        Garante que o pool de conexões comporte todas as threads
+        
+        max_workers pode ser alterado depois do __init__ (ex: benchmark);
+        com o pool menor que o número de threads, o urllib3 abre conexões
+        extras e as descarta ao final, perdendo o keep-alive.
+        """
+        pool_maxsize = self.max_workers * 2
+        if pool_maxsize <= self._pool_maxsize:
+            return
+        
+        previous = self.session.adapters.get('https://') if self._pool_maxsize else None
+        
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._pool_maxsize = pool_maxsize
+        
+        if previous is not None:
+            previous.close()
+    
+    def close(self):
+        """Fecha a sessão HTTP e libera as conexões do pool"""
+        self.session.close()
+    
+    def cancel(self):
+        """
+        Pede a interrupção da extração em andamento (pode ser chamado de
+        outra thread)
+        
+        As requisições seguintes e iter_messages levantam ExtractionCancelled;
+        esperas de Retry-After e backoff são interrompidas na hora.
+        """
+        self._cancel_event.set()
+    
+    def _check_cancelled(self):
+        """Levanta ExtractionCancelled se cancel() foi chamado"""
+        if self._cancel_event.is_set():
+            raise ExtractionCancelled("Extração cancelada")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def _log(self, message: str, progress: int = None):
         """Log interno que decide entre print ou callback"""
         if self.progress_callback and progress is not None:
@@ -87,10 +355,192 @@ class ChatwootETL:
         
         # Só imprime se NÂO tiver callback E tiver stdout disponível
         # Evita crash em modo windowed
+        # tqdm.write não quebra as barras de progresso ativas
         if not self.progress_callback:
             if sys.stdout is not None:
-                print(message)
+                tqdm.write(message)
 
+    def _request_interval(self) -> float:
+        """
+        Intervalo entre requisições do limitador: rate_limit_delay, limitado
+        a 1 / max_request_rate (um delay 0 vira a taxa máxima)
+        """
+        return max(self.rate_limit_delay, 1.0 / self.max_request_rate)
+    
+    def _acquire_rate_token(self):
+        """
+        Aguarda um token do bucket antes de disparar uma requisição
+        
+        A taxa de reposição é 1 / _request_interval() tokens por segundo e é
+        compartilhada por todas as threads do pool.
+        """
+        with self._rate_lock:
+            now = time.monotonic()
+            rate = 1.0 / self._request_interval()
+            self._tokens = min(self.rate_limit_burst, self._tokens + (now - self._last_refill) * rate)
+            self._last_refill = now
+            
+            # Reserva o token mesmo que ainda não exista (saldo negativo),
+            # assim cada thread dorme apenas o tempo da sua vez
+            wait = (1.0 - self._tokens) / rate if self._tokens < 1.0 else 0.0
+            self._tokens -= 1.0
+        
+        if wait > 0:
+            time.sleep(wait)
+    
+    def _adjust_rate(self, throttled: bool):
+        """
+        Ajusta a taxa do limitador: reduz 30% após um 429 e aumenta 10%
+        a cada rate_increase_after respostas bem-sucedidas seguidas, até
+        max_request_rate
+        """
+        with self._rate_lock:
+            if throttled:
+                self._success_streak = 0
+                self.rate_limit_delay = min(self._request_interval() / 0.7, 3.0)
+                return
+            
+            self._success_streak += 1
+            if self._success_streak >= self.rate_increase_after:
+                self._success_streak = 0
+                self.rate_limit_delay = max(self._request_interval() / 1.1, 1.0 / self.max_request_rate)
+    
+    def _backoff_delay(self, attempt: int) -> float:
+        """
+        Espera antes da próxima tentativa: exponential backoff com "full jitter"
+        
+        O sorteio evita que as threads que falharam juntas tentem de novo
+        todas no mesmo instante.
+        """
+        return random.uniform(0, min(self.max_backoff, 2 ** attempt))
+    
+    @staticmethod
+    def _parse_retry_after(value: Optional[str], default: float = 60.0) -> float:
+        """Converte o header Retry-After (segundos ou data HTTP) em segundos"""
+        if not value:
+            return default
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+            return max(retry_at.timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return default
+    
+    def _http_cache_file(self, url: str, params: Optional[Dict]) -> Path:
+        """Arquivo de cache HTTP para a combinação URL + parâmetros"""
+        key = url + json.dumps(params or {}, sort_keys=True, default=str)
+        return self.cache_dir / 'http' / (hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pkl')
+    
+    def _load_http_cache(self, cache_file: Path) -> Optional[Dict]:
+        """
+        Carrega uma resposta em cache ({'etag': ..., 'body': ...}), se houver
+        
+        Entradas mais antigas que cache_ttl são descartadas.
+        """
+        try:
+            if time.time() - cache_file.stat().st_mtime >= self.cache_ttl:
+                cache_file.unlink(missing_ok=True)
+                return None
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            return None
+    
+    def _prune_http_cache(self):
+        """Remove do disco as respostas em cache expiradas (mais antigas que cache_ttl)"""
+        self._http_cache_pruned = True
+        expires_before = time.time() - self.cache_ttl
+        try:
+            for cache_file in (self.cache_dir / 'http').glob('*.pkl'):
+                try:
+                    if cache_file.stat().st_mtime < expires_before:
+                        cache_file.unlink(missing_ok=True)
+                except OSError:
+                    pass
+        except OSError:
+            pass
+    
+    def _save_http_cache(self, cache_file: Path, etag: str, body):
+        """Grava a resposta em cache de forma atômica (seguro entre threads)"""
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_suffix(f'.{threading.get_ident()}.tmp')
+            with open(tmp_file, 'wb') as f:
+                pickle.dump({'etag': etag, 'body': body}, f)
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            self._log(f"⚠️  Não foi possível salvar cache HTTP: {e}")
+    
+    def _read_checkpoint(self, name: str) -> List[Dict]:
+        """
+        Lê as entradas de um checkpoint NDJSON
+        
+        Uma última linha truncada (processo interrompido durante a escrita)
+        é ignorada.
+        """
+        entries = []
+        try:
+            with open(self.checkpoint_dir / f'{name}.ndjson', 'rb') as f:
+                for line in f:
+                    try:
+                        entries.append(_json_loads(line))
+                    except ValueError:
+                        break
+        except FileNotFoundError:
+            pass
+        return entries
+    
+    def _index_checkpointed_messages(self) -> Dict[int, int]:
+        """
+        Indexa o checkpoint de mensagens (conversation_id -> posição da linha)
+        
+        Só as posições ficam em memória; as mensagens são lidas do disco
+        quando a conversa é processada (_read_checkpointed_messages).
+        """
+        offsets = {}
+        offset = 0
+        try:
+            with open(self.checkpoint_dir / 'messages.ndjson', 'rb') as f:
+                for line in f:
+                    try:
+                        offsets[_json_loads(line)['conversation_id']] = offset
+                    except (ValueError, KeyError):
+                        break
+                    offset += len(line)
+        except FileNotFoundError:
+            pass
+        return offsets
+    
+    def _read_checkpointed_messages(self, conversation_id: int) -> Optional[List[Dict]]:
+        """Lê (uma única vez) as mensagens de uma conversa do checkpoint, se houver"""
+        offset = self._checkpoint_offsets.pop(conversation_id, None)
+        if offset is None:
+            return None
+        try:
+            with open(self.checkpoint_dir / 'messages.ndjson', 'rb') as f:
+                f.seek(offset)
+                return _json_loads(f.readline())['messages']
+        except (OSError, ValueError, KeyError):
+            return None
+    
+    def _append_checkpoint(self, name: str, entry: Dict):
+        """Acrescenta uma entrada ao checkpoint NDJSON (seguro entre threads)"""
+        try:
+            with self._checkpoint_lock:
+                self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+                with open(self.checkpoint_dir / f'{name}.ndjson', 'ab') as f:
+                    f.write(_json_dumps(entry) + b'\n')
+        except Exception as e:
+            self._log(f"⚠️  Não foi possível gravar checkpoint: {e}")
+    
+    def clear_checkpoints(self):
+        """Remove os checkpoints (execução concluída ou nova extração)"""
+        self._checkpoint_offsets = {}
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+    
     def _make_request(self, endpoint: str, params: Optional[Dict] = None, debug: bool = False) -> Optional[Dict]:
         """
         Faz requisição à API com tratamento de erros e rate limiting
@@ -98,7 +548,7 @@ class ChatwootETL:
         Args:
             endpoint: Endpoint da API (ex: /api/v1/accounts/{account_id}/inboxes)
             params: Parâmetros da query string
-            debug: Se True, mostra detalhes completos da resposta
+            debug: Se True, mostra a URL, os parâmetros e o corpo bruto das respostas de erro
             
         Returns:
             Resposta JSON ou None em caso de erro
@@ -110,24 +560,51 @@ class ChatwootETL:
             if params:
                 self._log(f"🔍 Parâmetros: {params}")
         
+        # Resposta anterior em cache: revalida com If-None-Match
+        cache_file = None
+        if self.http_cache and endpoint.endswith(self.HTTP_CACHE_ENDPOINTS):
+            if not self._http_cache_pruned:
+                self._prune_http_cache()
+            cache_file = self._http_cache_file(url, params)
+        cached = self._load_http_cache(cache_file) if cache_file else None
+        request_headers = {'If-None-Match': cached['etag']} if cached else None
+        
         for attempt in range(self.max_retries):
+            self._check_cancelled()
             try:
-                response = requests.get(url, headers=self.headers, params=params, timeout=30)
+                # Respeita a janela de Retry-After compartilhada entre as threads
+                # (a espera termina antes se a extração for cancelada)
+                wait_retry = self._retry_not_before - time.monotonic()
+                if wait_retry > 0:
+                    self._cancel_event.wait(wait_retry)
+                    self._check_cancelled()
+                
+                if self.adaptive_rate_limit:
+                    self._acquire_rate_token()
+                
+                response = self.session.get(url, params=params, headers=request_headers, timeout=30)
                 
                 # Rate limiting - Too Many Requests
                 if response.status_code == 429:
-                    retry_after = int(response.headers.get('Retry-After', 60))
-                    self._log(f"⚠️  Rate limit atingido. Aguardando {retry_after}s...")
-                    time.sleep(retry_after)
-                    # Aumenta o delay para futuras requisições
-                    if self.adaptive_rate_limit:
-                        self.rate_limit_delay = min(self.rate_limit_delay * 1.5, 3.0)
+                    retry_after = self._parse_retry_after(response.headers.get('Retry-After'))
+                    self._log(f"⚠️  Rate limit atingido. Aguardando {retry_after:.0f}s...")
+                    # Uma única janela para todas as threads (a espera acontece
+                    # no início da próxima tentativa, sem acumular por thread)
+                    with self._rate_lock:
+                        now = time.monotonic()
+                        new_window = self._retry_not_before <= now
+                        self._retry_not_before = max(self._retry_not_before, now + retry_after)
+                    # Reduz a taxa para futuras requisições, uma vez por janela
+                    # (os 429 simultâneos das outras threads não acumulam)
+                    if self.adaptive_rate_limit and new_window:
+                        self._adjust_rate(throttled=True)
                     continue
                 
                 # Erro de autenticação
                 if response.status_code == 401:
                     self._log(f"❌ Erro 401: Autenticação falhou")
-                    self._log(f"🔍 Resposta: {response.text[:500]}")
+                    if debug:
+                        self._log(f"🔍 Resposta: {response.text[:500]}")
                     raise Exception("❌ Erro de autenticação. Verifique seu ACCESS_TOKEN")
                 
                 # Outros erros HTTP
@@ -137,35 +614,45 @@ class ChatwootETL:
                     
                     # Mostra resposta de erro para debug
                     try:
-                        error_data = response.json()
+                        error_data = _json_loads(response.content)
                         self._log(f"🔍 Detalhes: {error_data}")
-                    except:
-                        self._log(f"🔍 Resposta: {response.text[:500]}")
+                    except ValueError:
+                        # Corpo bruto (decodifica o texto) só no modo debug
+                        if debug:
+                            self._log(f"🔍 Resposta: {response.text[:500]}")
                     
                     if attempt < self.max_retries - 1:
-                        time.sleep(2 ** attempt)  # Exponential backoff
+                        self._cancel_event.wait(self._backoff_delay(attempt))  # Exponential backoff com jitter
                         continue
                     return None
                 
                 # Sucesso
                 if self.adaptive_rate_limit:
-                    # Calcula tempo decorrido desde última requisição
-                    elapsed = time.time() - self.last_request_time
-                    if elapsed < self.rate_limit_delay:
-                        time.sleep(self.rate_limit_delay - elapsed)
-                    
-                    # Reduz gradualmente o delay após requisições bem-sucedidas
-                    self.rate_limit_delay = max(self.rate_limit_delay * 0.95, 0.1)
-                    self.last_request_time = time.time()
+                    # Aumenta gradualmente a taxa após requisições bem-sucedidas
+                    self._adjust_rate(throttled=False)
                 else:
                     time.sleep(self.rate_limit_delay)  # Delay fixo
-                    
-                return response.json()
+                
+                # Não modificado desde a última execução: usa o corpo em cache
+                if response.status_code == 304 and cached:
+                    return cached['body']
+                
+                try:
+                    data = _json_loads(response.content)
+                except ValueError as e:
+                    self._log(f"❌ Resposta inválida (JSON) em {endpoint}: {str(e)}")
+                    return None
+                
+                etag = response.headers.get('ETag')
+                if cache_file and etag:
+                    self._save_http_cache(cache_file, etag, data)
+                
+                return data
                 
             except requests.exceptions.Timeout:
                 self._log(f"⚠️  Timeout na requisição. Tentativa {attempt + 1}/{self.max_retries}")
                 if attempt < self.max_retries - 1:
-                    time.sleep(2 ** attempt)
+                    self._cancel_event.wait(self._backoff_delay(attempt))
                     continue
                 return None
                 
@@ -175,10 +662,14 @@ class ChatwootETL:
         
         return None
     
-    def load_inbox_map(self) -> bool:
+    def load_inbox_map(self, use_cache: bool = True) -> bool:
         """
         Carrega o mapeamento de Inboxes (id -> nome do canal) com cache
         
+        Args:
+            use_cache: Se False, ignora o cache em disco e busca da API
+                (o cache é atualizado com a resposta)
+        
         Returns:
             True se bem sucedido, False caso contrário
         """
@@ -187,7 +678,7 @@ class ChatwootETL:
         # Tenta carregar do cache primeiro
         cache_file = self.cache_dir / 'inbox_map.pkl'
         
-        if cache_file.exists():
+        if use_cache and cache_file.exists():
             cache_age = time.time() - cache_file.stat().st_mtime
             if cache_age < self.cache_ttl:
                 try:
@@ -262,119 +753,199 @@ class ChatwootETL:
             
         self._log("🔍 Filtrando conversas por data de atividade...", 50)
         
+        # Compara o timestamp Unix direto, sem criar um datetime por conversa.
+        # Se a última atividade foi antes do início do filtro, a conversa não
+        # tem mensagens no período; sem data (ou data inválida) a conversa é mantida
+        start_ts = self.start_date.timestamp()
+        
         filtered_conversations = []
         for conv in conversations:
             last_activity = conv.get('last_activity_at')
-            if last_activity:
-                try:
-                    last_act_dt = datetime.fromtimestamp(last_activity)
-                    if last_act_dt >= self.start_date:
-                        filtered_conversations.append(conv)
-                except:
-                    filtered_conversations.append(conv)
-            else:
+            if not last_activity or not isinstance(last_activity, (int, float)) or last_activity >= start_ts:
                 filtered_conversations.append(conv)
         return filtered_conversations
 
     def _get_conversations_all_status(self) -> List[Dict]:
         """
         Tenta buscar todas as conversas com diferentes filtros de status
+        
+        Os demais status só são tentados se 'all' falhar (erro HTTP ou
+        resposta em formato desconhecido), já que são subconjuntos dele.
         """
-        all_conversations = []
+        endpoint = f"/api/v1/accounts/{self.account_id}/conversations"
+        base_params = {
+            'page': 1,
+            'include': 'messages'  # Conversas curtas já vêm com as mensagens
+        }
         
-        # Tenta com diferentes status (open, resolved, pending, snoozed, all)
-        status_filters = ['all', 'open', 'resolved', 'pending']
+        # Adiciona filtros de data se disponíveis (otimização)
+        if self.start_date:
+            base_params['since'] = int(self.start_date.timestamp())
+        if self.end_date:
+            base_params['until'] = int(self.end_date.timestamp())
         
-        for status in status_filters:
+        # Tenta com diferentes status (open, resolved, pending, snoozed, all)
+        for status in self.STATUS_FILTERS:
             self._log(f"🔍 Tentando buscar conversas com status: {status}")
             
-            page = 1
-            endpoint = f"/api/v1/accounts/{self.account_id}/conversations"
-            params = {
-                'page': page,
-                'status': status
-            }
+            params = {**base_params, 'status': status}
             
-            # Adiciona filtros de data se disponíveis (otimização)
-            if self.start_date:
-                params['since'] = int(self.start_date.timestamp())
-            if self.end_date:
-                params['until'] = int(self.end_date.timestamp())
-            
-            response = self._make_request(endpoint, params, debug=True)
+            response = self._make_request(endpoint, params)
             
             if not response:
                 continue
             
             # Verifica estrutura da resposta
-            if 'data' in response and 'meta' in response:
-                # Formato: {data: {payload: [...]}, meta: {...}}
+            # Formatos: {data: {payload: [...]}, meta: {...}} ou {payload: [...], meta: {...}}
+            if 'meta' in response and ('data' in response or 'payload' in response):
                 total_count = response['meta'].get('count', 0)
-                payload = response['data'].get('payload', [])
+                payload = self._extract_payload(response)
                 
                 if total_count > 0:
                     self._log(f"✅ Encontradas {total_count} conversas com status '{status}'")
-                    all_conversations.extend(payload)
+                    # Conversas com atividade nova mudam de página durante a
+                    # paginação e podem vir repetidas; deduplica por ID na inserção
+                    unique_conversations = {}
+                    for conv in payload:
+                        unique_conversations.setdefault(conv.get('id'), conv)
                     
                     # Calcula número de páginas
                     per_page = response['meta'].get('per_page', 25)
                     total_pages = (total_count + per_page - 1) // per_page
                     
-                    # Busca páginas restantes
-                    if total_pages > 1:
-                        with tqdm(total=total_pages, desc=f"Páginas [{status}]", unit="página") as pbar:
-                            pbar.update(1)
-                            
-                            page = 2
-                            while page <= total_pages:
-                                params['page'] = page
-                                response = self._make_request(endpoint, params)
-                                
-                                if response and 'data' in response:
-                                    conversations = response['data'].get('payload', [])
-                                    if conversations:
-                                        all_conversations.extend(conversations)
-                                    else:
-                                        break
-                                    pbar.update(1)
-                                    page += 1
-                                else:
-                                    break
+                    # Páginas vêm ordenadas por atividade (mais recente primeiro):
+                    # com data inicial, para de paginar ao passar do período
+                    stop_before = int(self.start_date.timestamp()) if self.start_date else None
+                    
+                    # Busca páginas restantes em paralelo (total já é conhecido)
+                    if total_pages > 1 and not self._page_ends_before(payload, stop_before):
+                        for conv in self._fetch_pages(endpoint, params, range(2, total_pages + 1), status, stop_before):
+                            unique_conversations.setdefault(conv.get('id'), conv)
                     
                     # Encontrou conversas, retorna
-                    return all_conversations
-            
-            elif 'payload' in response and 'meta' in response:
-                # Formato alternativo: {payload: [...], meta: {...}}
-                total_count = response['meta'].get('count', 0)
-                payload = response.get('payload', [])
+                    return list(unique_conversations.values())
                 
-                if total_count > 0:
-                    self._log(f"✅ Encontradas {total_count} conversas com status '{status}'")
-                    all_conversations = payload
-                    return all_conversations
+                # 'all' respondeu com contagem zero: os demais status são
+                # subconjuntos dele, então não há o que buscar neles
+                if status == 'all' and 'count' in response['meta']:
+                    self._log("⚠️  Nenhuma conversa com status 'all'")
+                    return []
         
-        return all_conversations
+        return []
+    
+    @staticmethod
+    def _extract_payload(response: Dict) -> List[Dict]:
+        """Extrai a lista de itens de uma resposta paginada, em qualquer um dos formatos"""
+        if isinstance(response.get('data'), dict):
+            return response['data'].get('payload', [])
+        return response.get('payload', [])
+    
+    @staticmethod
+    def _page_ends_before(page: List[Dict], timestamp: Optional[int]) -> bool:
+        """
+        Indica se uma página (ordenada por last_activity_at decrescente)
+        termina antes do timestamp, ou seja, se as próximas páginas só
+        contêm conversas sem atividade no período
+        
+        Páginas fora de ordem nunca encerram a paginação.
+        """
+        if timestamp is None or not page:
+            return False
+        
+        activity = [conv.get('last_activity_at') for conv in page]
+        if not all(isinstance(ts, (int, float)) for ts in activity):
+            return False
+        if any(newer < older for newer, older in zip(activity, activity[1:])):
+            return False
+        
+        return activity[-1] < timestamp
+    
+    def _fetch_pages(self, endpoint: str, params: Dict, pages: range, status: str,
+                     stop_before: Optional[int] = None) -> List[Dict]:
+        """
+        Busca em paralelo as páginas informadas de um endpoint paginado
+        
+        As requisições passam pelo mesmo _make_request (e rate limiter) das
+        demais chamadas. Com `stop_before`, as páginas são buscadas em ondas de
+        max_workers e a paginação termina na onda cuja última página já não tem
+        atividade a partir desse timestamp.
+        
+        Returns:
+            Itens de todas as páginas, na ordem das páginas
+        """
+        # Checkpoint das páginas desta listagem (mesmo endpoint + filtros)
+        checkpoint_key = json.dumps([endpoint, params], sort_keys=True, default=str)
+        checkpoint_name = 'pages_' + hashlib.sha1(checkpoint_key.encode('utf-8')).hexdigest()[:12]
+        checkpointed_pages = {}
+        if self.resume:
+            checkpointed_pages = {entry['page']: entry['items'] for entry in self._read_checkpoint(checkpoint_name)}
+        
+        def fetch_page(page):
+            if page in checkpointed_pages:
+                return checkpointed_pages[page]
+            
+            response = self._make_request(endpoint, {**params, 'page': page})
+            if response:
+                payload = self._extract_payload(response)
+                if self.checkpoint and payload:
+                    self._append_checkpoint(checkpoint_name, {'page': page, 'items': payload})
+                return payload
+            return []
+        
+        self._ensure_connection_pool()
+        
+        items = []
+        workers = max(1, min(self.max_workers, len(pages)))
+        wave_size = workers if stop_before is not None else len(pages)
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map preserva a ordem das páginas
+            with tqdm(total=len(pages) + 1, initial=1, desc=f"Páginas [{status}]", unit="página",
+                      mininterval=TQDM_MININTERVAL, miniters=_tqdm_miniters(len(pages))) as pbar:
+                for wave_start in range(0, len(pages), wave_size):
+                    payload = []
+                    for payload in executor.map(fetch_page, pages[wave_start:wave_start + wave_size]):
+                        items.extend(payload)
+                        pbar.update(1)
+                    
+                    if self._page_ends_before(payload, stop_before):
+                        break
+        
+        return items
     
     def _get_conversations_by_inbox(self) -> List[Dict]:
         """
         Busca conversas iterando por cada inbox
         Útil quando a busca global não funciona
         """
-        all_conversations = []
+        # Conversas únicas por ID (a mesma conversa pode aparecer em mais de
+        # um inbox/status); deduplica já na inserção, mantendo a primeira
+        unique_conversations = {}
         
         self._log(f"📨 Buscando conversas por canal (inbox)...")
         
-        for inbox_id, inbox_name in tqdm(self.inbox_map.items(), desc="Canais processados", unit="canal"):
-            endpoint = f"/api/v1/accounts/{self.account_id}/conversations"
-            
+        # Combinações de parâmetros que funcionaram em execuções anteriores
+        params_cache_file = self.cache_dir / 'inbox_params.pkl'
+        if not self._inbox_param_cache and params_cache_file.exists():
+            try:
+                with open(params_cache_file, 'rb') as f:
+                    self._inbox_param_cache = pickle.load(f)
+            except Exception:
+                self._inbox_param_cache = {}
+        
+        endpoint = f"/api/v1/accounts/{self.account_id}/conversations"
+        
+        for inbox_id, inbox_name in tqdm(self.inbox_map.items(), desc="Canais processados", unit="canal",
+                                            mininterval=TQDM_MININTERVAL):
             # Tenta diferentes combinações de parâmetros
-            param_combinations = [
-                {'inbox_id': inbox_id, 'status': 'all'},
-                {'inbox_id': inbox_id, 'status': 'open'},
-                {'inbox_id': inbox_id, 'status': 'resolved'},
-                {'inbox_id': inbox_id},
-            ]
+            param_combinations = [{'inbox_id': inbox_id, **template} for template in self.INBOX_PARAM_TEMPLATES]
+            
+            # Tenta primeiro a combinação que já funcionou para este inbox
+            # (entrada de um cache antigo, fora das combinações atuais, é ignorada)
+            cached_params = self._inbox_param_cache.get(inbox_id)
+            if cached_params is not None and cached_params in param_combinations:
+                param_combinations.remove(cached_params)
+                param_combinations.insert(0, cached_params)
             
             for params in param_combinations:
                 response = self._make_request(endpoint, params)
@@ -389,28 +960,29 @@ class ChatwootETL:
                         conversations = response['payload']
                     
                     if conversations:
-                        self._log(f"   ✅ {len(conversations)} conversas em '{inbox_name}'")
-                        all_conversations.extend(conversations)
+                        logger.debug("%d conversas em '%s'", len(conversations), inbox_name)
+                        for conv in conversations:
+                            unique_conversations.setdefault(conv.get('id'), conv)
+                        self._inbox_param_cache[inbox_id] = params
                         break  # Encontrou com essa combinação, próximo inbox
         
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            with open(params_cache_file, 'wb') as f:
+                pickle.dump(self._inbox_param_cache, f)
+        except Exception as e:
+            self._log(f"⚠️  Não foi possível salvar cache: {e}")
+        
+        all_conversations = list(unique_conversations.values())
+        
         if all_conversations:
-            # Remove duplicatas (mesma conversa pode aparecer em múltiplos status)
-            # Otimizado: usa set para tracking de IDs já vistos
-            seen_ids = set()
-            unique_conversations = []
-            for conv in all_conversations:
-                conv_id = conv.get('id')
-                if conv_id not in seen_ids:
-                    seen_ids.add(conv_id)
-                    unique_conversations.append(conv)
-            all_conversations = unique_conversations
             self._log(f"\n✅ Total: {len(all_conversations)} conversas únicas carregadas\n")
         else:
             self._log("\n❌ Nenhuma conversa encontrada em nenhum canal\n")
         
         return all_conversations
     
-    def get_conversation_messages(self, conversation_id: int) -> List[Dict]:
+    def get_conversation_messages(self, conversation_id: int) -> Optional[List[Dict]]:
         """
         Obtém todas as mensagens de uma conversa específica
         
@@ -418,171 +990,381 @@ class ChatwootETL:
             conversation_id: ID da conversa
             
         Returns:
-            Lista de mensagens
+            Lista de mensagens, ou None se a requisição falhar
         """
         endpoint = f"/api/v1/accounts/{self.account_id}/conversations/{conversation_id}/messages"
         response = self._make_request(endpoint)
         
         if not response or 'payload' not in response:
-            return []
+            return None
         
         return response['payload']
     
-    def transform_messages(self, conversations: List[Dict]) -> List[Dict]:
+    def _intern(self, value):
         """
-        Transforma as conversas e mensagens no formato desejado
-        Versão otimizada com paralelização de requisições HTTP
+        Retorna uma instância compartilhada de valores repetidos (nomes,
+        e-mails, canais), para que milhares de mensagens apontem para o
+        mesmo objeto em vez de cópias vindas de cada resposta JSON
         """
-        self._log("🔄 Transformando dados...", 70)
+        if value is None:
+            return None
+        return self._interned.setdefault(value, value)
+    
+    @staticmethod
+    def _in_window(created_at, start_ts: Optional[float], end_ts: Optional[float]) -> bool:
+        """
+        Indica se um timestamp Unix está dentro do período [start_ts, end_ts]
+        
+        Mensagens sem data (ou com data inválida) são mantidas.
+        """
+        if not created_at or not isinstance(created_at, (int, float)):
+            return True
+        if start_ts is not None and created_at < start_ts:
+            return False
+        if end_ts is not None and created_at > end_ts:
+            return False
+        return True
+    
+    def _fetch_and_build(self, conversation: Dict) -> List[Message]:
+        """
+        Busca as mensagens de uma conversa e monta os registros de saída
+        
+        Args:
+            conversation: Conversa retornada pela API
+            
+        Returns:
+            Lista de mensagens transformadas da conversa
+        """
+        # Atributos usados no laço de mensagens, resolvidos uma vez
+        intern = self._intern
+        
+        conversation_id = conversation.get('id')
+        inbox_id = conversation.get('inbox_id')
+        
+        # Dados do cliente ('meta'/'sender' podem vir ausentes ou nulos)
+        meta = conversation.get('meta') or {}
+        contact = meta.get('sender') or {}
+        customer_name = intern(contact.get('name', 'Cliente Desconhecido'))
+        customer_email = intern(contact.get('email', ''))
+        
+        # Nome do canal (o nome genérico só é formatado se o inbox não estiver no mapa)
+        channel_name = self.inbox_map.get(inbox_id)
+        if channel_name is None:
+            channel_name = f'Canal ID {inbox_id}'
+        channel_name = intern(channel_name)
         
-        transformed_messages = []
-        total = len(conversations)
+        # Usa as mensagens embutidas na listagem quando já estão completas;
+        # senão busca as mensagens desta conversa (pode ser demorado)
+        embedded = conversation.get('messages')
+        messages_count = conversation.get('messages_count')
+        if embedded and isinstance(messages_count, int) and len(embedded) >= messages_count:
+            messages = embedded
+        else:
+            messages = self._read_checkpointed_messages(conversation_id)
+            if messages is None:
+                messages = self.get_conversation_messages(conversation_id)
+                if messages is None:
+                    # Falha na API: não grava no checkpoint, para que --resume tente de novo
+                    self._log(f"⚠️  Não foi possível obter as mensagens da conversa {conversation_id}")
+                    self.failed_conversations.append(conversation_id)
+                    messages = []
+                elif self.checkpoint:
+                    self._append_checkpoint('messages', {'conversation_id': conversation_id, 'messages': messages})
+        
+        # Filtro de Data nas MENSAGENS: compara o timestamp Unix com a janela
+        # do período antes de formatar (só as mensagens mantidas são convertidas)
+        start_ts = self.start_date.timestamp() if self.start_date else None
+        end_ts = self.end_date.timestamp() if self.end_date else None
+        if start_ts is not None or end_ts is not None:
+            in_window = self._in_window
+            messages = [msg for msg in messages if in_window(msg.get('created_at'), start_ts, end_ts)]
+        
+        # Converte os timestamps da conversa de uma vez (coluna)
+        created_at_isos = _format_timestamps([msg.get('created_at') for msg in messages])
         
-        # Função helper para processar uma conversa
-        def process_conversation(conversation):
-            conversation_id = conversation.get('id')
-            inbox_id = conversation.get('inbox_id')
+        conv_messages = []
+        append = conv_messages.append
+        for msg, created_at_iso in zip(messages, created_at_isos):
+            # Determina o tipo de mensagem
+            message_type = msg.get('message_type', 'outgoing')
             
-            # Dados do cliente
-            contact = conversation.get('meta', {}).get('sender', {})
-            customer_name = contact.get('name', 'Cliente Desconhecido')
-            customer_email = contact.get('email', '')
+            # Dados do remetente
+            sender = msg.get('sender')
+            sender_name = customer_name
+            agent_email = None
             
-            # Nome do canal
-            channel_name = self.inbox_map.get(inbox_id, f'Canal ID {inbox_id}')
+            if sender and sender.get('type') == 'User':
+                sender_name = intern(sender.get('name', 'Agente Desconhecido'))
+                agent_email = intern(sender.get('email', ''))
             
-            # Busca as mensagens desta conversa (pode ser demorado)
-            messages = self.get_conversation_messages(conversation_id)
+            # Conteúdo da mensagem
+            content = msg.get('content', '')
             
-            conv_messages = []
-            for msg in messages:
-                # Determina o tipo de mensagem
-                message_type = msg.get('message_type', 'outgoing')
-                
-                # Dados do remetente
-                sender = msg.get('sender')
-                sender_name = customer_name
-                agent_email = None
-                
-                if sender and sender.get('type') == 'User':
-                    sender_name = sender.get('name', 'Agente Desconhecido')
-                    agent_email = sender.get('email', '')
-                
-                # Conteúdo da mensagem
-                content = msg.get('content', '')
-                
-                # Data de criação em formato ISO 8601
-                created_at = msg.get('created_at')
-                created_at_iso = None
-                
-                if created_at:
-                    try:
-                        dt = datetime.fromtimestamp(created_at)
-                        created_at_iso = dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-                    except:
-                        created_at_iso = str(created_at)
-                
-                # Filtro de Data nas MENSAGENS
-                if created_at:
-                    try:
-                        msg_dt = datetime.fromtimestamp(created_at)
-                        
-                        if self.start_date and msg_dt < self.start_date:
-                            continue
-                        if self.end_date and msg_dt > self.end_date:
-                            continue
-                    except:
-                        pass
-                
-                # Monta o objeto de mensagem
-                message_obj = {
-                    "conversation_id": conversation_id,
-                    "customer_name": customer_name,
-                    "customer_email": customer_email,
-                    "channel_name": channel_name,
-                    "message_type": message_type,
-                    "sender_name": sender_name,
-                    "content": content,
-                    "created_at_iso": created_at_iso,
-                    "agent_email": agent_email
-                }
-                
-                conv_messages.append(message_obj)
+            # Monta o objeto de mensagem
+            append(Message(
+                conversation_id=conversation_id,
+                customer_name=customer_name,
+                customer_email=customer_email,
+                channel_name=channel_name,
+                message_type=message_type,
+                sender_name=sender_name,
+                content=content,
+                created_at_iso=created_at_iso,
+                agent_email=agent_email
+            ))
+        
+        return conv_messages
+
+    def iter_messages(self, conversations: Iterable[Dict]) -> Iterator[Message]:
+        """
+        Gera as mensagens transformadas conforme as conversas são processadas
+        Versão otimizada com paralelização de requisições HTTP
+        
+        Mantém no máximo max_workers * 2 conversas em andamento, então a
+        memória fica limitada ao lote em processamento e o resultado pode
+        ser gravado em disco sem materializar a lista completa de mensagens.
+        
+        Raises:
+            ExtractionCancelled: se cancel() for chamado durante a iteração
+        """
+        self._log("🔄 Transformando dados...", 70)
+        
+        self._ensure_connection_pool()
+        self.failed_conversations = []
+        
+        # Mensagens já baixadas por uma execução interrompida (só o índice
+        # fica em memória; cada conversa é lida do disco ao ser processada)
+        if self.resume and not self._checkpoint_offsets:
+            self._checkpoint_offsets = self._index_checkpointed_messages()
+            if self._checkpoint_offsets:
+                self._log(f"♻️  {len(self._checkpoint_offsets)} conversas retomadas do checkpoint")
+        
+        total = len(conversations) if hasattr(conversations, '__len__') else None
+        completed = 0
+        
+        # Próxima contagem de conversas em que o progresso é reportado
+        progress_step = max(1, total // PROGRESS_STEPS) if total else 0
+        next_report = progress_step
+        
+        def report_progress():
+            nonlocal next_report
+            # Reporta progresso se tiver callback
+            if self.progress_callback and total and (completed >= next_report or completed == total):
+                next_report += progress_step
+                current_percent = 70 + completed * 20 // total
+                self._log(f"Processando conversa {completed}/{total}...", current_percent)
+        
+        # Se não tiver callback, usa tqdm para progresso
+        # Com callback o progresso vai só para ele (sem barra no terminal)
+        with tqdm(total=total, desc="Processando conversas", unit="conversa",
+                  mininterval=TQDM_MININTERVAL, miniters=_tqdm_miniters(total),
+                  disable=bool(self.progress_callback)) as pbar:
             
-            return conv_messages
-        
-        # Processamento paralelo
-        if self.max_workers > 1:
-            # Usa ThreadPoolExecutor para paralelizar as requisições
-            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                # Submete todas as conversas para processamento paralelo
-                futures = {executor.submit(process_conversation, conv): i 
-                          for i, conv in enumerate(conversations)}
-                
-                # Se não tiver callback, usa tqdm para progresso
-                if not self.progress_callback:
-                    futures_iter = tqdm(as_completed(futures), 
-                                       total=total, 
-                                       desc="Processando conversas", 
-                                       unit="conversa")
-                else:
-                    futures_iter = as_completed(futures)
+            # Processamento paralelo
+            if self.max_workers > 1:
+                max_in_flight = self.max_workers * 2
+                conversation_iter = iter(conversations)
+                pending = set()
                 
-                # Coleta resultados conforme completam
-                completed = 0
-                for future in futures_iter:
-                    try:
-                        messages = future.result()
-                        transformed_messages.extend(messages)
+                # Usa ThreadPoolExecutor para paralelizar as requisições
+                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    while True:
+                        self._check_cancelled()
+                        
+                        # Completa a janela de conversas em andamento
+                        for conversation in conversation_iter:
+                            pending.add(executor.submit(self._fetch_and_build, conversation))
+                            if len(pending) >= max_in_flight:
+                                break
                         
-                        # Reporta progresso se tiver callback
-                        if self.progress_callback:
+                        if not pending:
+                            break
+                        
+                        # Entrega resultados conforme completam
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
                             completed += 1
-                            if completed % 10 == 0:
-                                current_percent = 70 + int((completed / total) * 20)
-                                self._log(f"Processando conversa {completed}/{total}...", current_percent)
+                            pbar.update(1)
+                            try:
+                                messages = future.result()
+                            except ExtractionCancelled:
+                                raise
+                            except Exception as e:
+                                self._log(f"⚠️  Erro ao processar conversa: {str(e)}")
+                                continue
+                            
+                            yield from messages
+                            report_progress()
+            else:
+                # Fallback: processamento sequencial
+                for conversation in conversations:
+                    self._check_cancelled()
+                    completed += 1
+                    pbar.update(1)
+                    try:
+                        messages = self._fetch_and_build(conversation)
+                    except ExtractionCancelled:
+                        raise
                     except Exception as e:
                         self._log(f"⚠️  Erro ao processar conversa: {str(e)}")
-        else:
-            # Fallback: processamento sequencial
-            iterator = conversations
-            if not self.progress_callback:
-                iterator = tqdm(conversations, desc="Processando conversas", unit="conversa")
-            
-            for i, conversation in enumerate(iterator):
-                if self.progress_callback and i % 10 == 0:
-                    current_percent = 70 + int((i / total) * 20)
-                    self._log(f"Processando conversa {i}/{total}...", current_percent)
-                
-                try:
-                    messages = process_conversation(conversation)
-                    transformed_messages.extend(messages)
-                except Exception as e:
-                    self._log(f"⚠️  Erro ao processar conversa: {str(e)}")
+                        continue
+                    
+                    yield from messages
+                    report_progress()
+    
+    def transform_messages(self, conversations: List[Dict]) -> List[Message]:
+        """
+        Transforma as conversas e mensagens no formato desejado
+        Retorna a lista completa (para gravação em streaming use iter_messages)
+        """
+        transformed_messages = list(self.iter_messages(conversations))
         
         self._log(f"✅ {len(transformed_messages)} mensagens processadas\n")
         return transformed_messages
     
-    def save_to_json(self, data: List[Dict], filename: str = 'chatwoot_history_dump.json'):
+    @contextmanager
+    def _saving(self, filename: str):
+        """
+        Envolve a gravação de um arquivo de saída: registra o início e o
+        tamanho final; um erro é registrado e propagado (arquivo incompleto
+        não é tratado como sucesso)
+        """
+        self._log(f"💾 Salvando dados em {filename}...")
+        try:
+            yield
+        except Exception as e:
+            self._log(f"❌ Erro ao salvar arquivo: {str(e)}")
+            raise
+        
+        file_size_mb = os.path.getsize(filename) / (1024 * 1024)
+        self._log(f"✅ Arquivo salvo com sucesso! ({file_size_mb:.2f} MB)")
+    
+    def save_to_json(self, data: Iterable[Union[Message, Dict]], filename: str = 'chatwoot_history_dump.json') -> int:
         """
         Salva os dados em arquivo JSON
+        
+        Os registros são serializados um a um (orjson, se disponível) e
+        escritos direto no arquivo, então `data` pode ser um gerador.
+        
+        Returns:
+            Número de registros gravados
+
         """
-        self._log(f"💾 Salvando dados em {filename}...", 90)
+        count = 0
+        with self._saving(filename), _open_output(filename) as f:
+            f.write(b'[')
+            for record in data:
+                f.write(b',\n' if count else b'\n')
+                f.write(_json_dumps(record))
+                count += 1
+            f.write(b'\n]\n' if count else b']\n')
         
-        try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            
-            file_size = os.path.getsize(filename)
-            file_size_mb = file_size / (1024 * 1024)
+        return count
+    
+    def save_to_jsonl(self, data: Iterable[Union[Message, Dict]], filename: str) -> int:
+        """
+        Salva os dados em arquivo JSON Lines (um registro por linha)
+        
+        Sem a lista envolvendo os registros: o arquivo pode ser lido linha a
+        linha (ou com pandas.read_json(lines=True)) sem carregar tudo.
+        
+        Returns:
+            Número de registros gravados
+
+        """
+        count = 0
+        with self._saving(filename), _open_output(filename) as f:
+            for record in data:
+                f.write(_json_dumps(record))
+                f.write(b'\n')
+                count += 1
+        
+        return count
+    
+    def save(self, data: Iterable[Union[Message, Dict]], filename: str) -> int:
+        """
+        Salva os dados no formato indicado pela extensão do arquivo
+        (.parquet, .jsonl ou, para qualquer outra, JSON). JSON e JSON Lines
+        podem ser compactados acrescentando .gz ou .zst (ex: .jsonl.zst)
+        
+        Returns:
+            Número de registros gravados
+        
+        Raises:
+            Exception: erro de escrita (o arquivo fica incompleto)
+        """
+        suffixes = [suffix.lower() for suffix in Path(filename).suffixes]
+        if suffixes and suffixes[-1] in COMPRESSION_SUFFIXES:
+            suffixes.pop()
+        suffix = suffixes[-1] if suffixes else ''
+        if suffix == '.parquet':
+            return self.save_to_parquet(data, filename)
+        if suffix == '.jsonl':
+            return self.save_to_jsonl(data, filename)
+        return self.save_to_json(data, filename)
+    
+    def save_to_parquet(self, data: Iterable[Union[Message, Dict]], filename: str, batch_size: int = 10000) -> int:
+        """
+        Salva os dados em arquivo Parquet (compressão zstd)
+        
+        Os registros são acumulados em lotes de `batch_size` linhas (por
+        coluna) e cada lote é gravado e liberado em seguida, então `data`
+        pode ser um gerador.
+        
+        Returns:
+            Número de registros gravados
+
+        """
+        pa, pq = _require_pyarrow()
+        
+        schema = pa.schema([
+            (name, pa.dictionary(pa.int32(), pa.string()) if type_name == 'category' else getattr(pa, type_name)())
+            for name, type_name in PARQUET_FIELDS
+        ])
+        
+        # Lote em colunas (uma lista por campo): sem um dict por linha e
+        # convertido direto em arrays Arrow
+        names = [name for name, _ in PARQUET_FIELDS]
+        get_fields = attrgetter(*names)
+        
+        def write_batch(columns):
+            # message_type pode vir como inteiro (API) ou texto (padrão)
+            columns['message_type'] = [None if v is None else str(v) for v in columns['message_type']]
+            writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+            return len(columns['conversation_id'])
+        
+        count = 0
+        with self._saving(filename), pq.ParquetWriter(filename, schema, compression='zstd') as writer:
+            columns = {name: [] for name in names}
+            appends = [columns[name].append for name in names]
+            pending = 0
             
-            self._log(f"✅ Arquivo salvo com sucesso! ({file_size_mb:.2f} MB)")
+            for record in data:
+                values = get_fields(record) if isinstance(record, Message) else [record.get(name) for name in names]
+                for append, value in zip(appends, values):
+                    append(value)
+                pending += 1
+                
+                if pending >= batch_size:
+                    count += write_batch(columns)
+                    columns = {name: [] for name in names}
+                    appends = [columns[name].append for name in names]
+                    pending = 0
             
-        except Exception as e:
-            self._log(f"❌ Erro ao salvar arquivo: {str(e)}")
+            if pending:
+                count += write_batch(columns)
+        
+        return count
     
     def run(self):
         """Executa o processo completo de ETL"""
+        try:
+            self._run()
+        finally:
+            self.close()
+    
+    def _run(self):
+        """Etapas do ETL (extração, filtro, transformação e gravação)"""
         self._log("=" * 60)
         self._log("🚀 CHATWOOT FULL ETL - EXTRACT")
         self._log("=" * 60)
@@ -590,6 +1372,17 @@ class ChatwootETL:
         
         start_time = time.time()
         
+        if self.output_format not in OUTPUT_EXTENSIONS:
+            raise ValueError(f"❌ Formato de saída inválido: {self.output_format}")
+        
+        # Falha cedo se o formato de saída exigir dependência ausente
+        if self.output_format == 'parquet':
+            _require_pyarrow()
+        
+        # Nova extração: descarta checkpoints de execuções anteriores
+        if self.checkpoint and not self.resume:
+            self.clear_checkpoints()
+        
         # Passo 1: Carregar mapeamento de canais
         if not self.load_inbox_map():
             self._log("❌ Falha ao carregar inboxes. Abortando...")
@@ -604,55 +1397,43 @@ class ChatwootETL:
 
         # Filtro de Conversas (Otimização)
         if self.start_date:
-            self._log("🔍 Filtrando conversas por data de atividade...")
             initial_count = len(conversations)
-            filtered_conversations = []
-            
-            for conv in conversations:
-                last_activity = conv.get('last_activity_at')
-                if last_activity:
-                    try:
-                        last_act_dt = datetime.fromtimestamp(last_activity)
-                        # Se a última atividade foi antes do início do filtro, 
-                        # a conversa definitivamente não tem mensagens no período (assumindo ordem cronológica)
-                        if last_act_dt >= self.start_date:
-                            filtered_conversations.append(conv)
-                    except:
-                        filtered_conversations.append(conv) # Mantém se não conseguir parsear
-                else:
-                    filtered_conversations.append(conv) # Mantém se não tiver data
-            
-            conversations = filtered_conversations
+            conversations = self.filter_conversations_by_date(conversations)
             self._log(f"   📉 Conversas após filtro: {len(conversations)} (de {initial_count})")
             
             if not conversations:
                 self._log("⚠️  Nenhuma conversa ativa no período selecionado")
                 return
         
-        # Passo 3: Transformar mensagens no formato desejado
-        transformed_data = self.transform_messages(conversations)
-        
-        if not transformed_data:
-            self._log("⚠️  Nenhuma mensagem para salvar")
-            return
-        
-        # Passo 4: Salvar em JSON
+        # Passo 3 e 4: Transformar mensagens e salvar (streaming)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
         if self.start_date and self.end_date:
             s_date = self.start_date.strftime("%Y-%m-%d")
             e_date = self.end_date.strftime("%Y-%m-%d")
-            filename = f"chatwoot_history_{s_date}_to_{e_date}_{timestamp}.json"
+            filename = f"chatwoot_history_{s_date}_to_{e_date}_{timestamp}"
         elif self.start_date:
             s_date = self.start_date.strftime("%Y-%m-%d")
-            filename = f"chatwoot_history_from_{s_date}_{timestamp}.json"
+            filename = f"chatwoot_history_from_{s_date}_{timestamp}"
         else:
-            filename = f"chatwoot_history_full_{timestamp}.json"
-            
-        self.save_to_json(transformed_data, filename)
+            filename = f"chatwoot_history_full_{timestamp}"
+        
+        filename += OUTPUT_EXTENSIONS[self.output_format]
+        message_count = self.save(self.iter_messages(conversations), filename)
+        
+        if not message_count:
+            self._log("⚠️  Nenhuma mensagem para salvar")
+            if os.path.exists(filename):
+                os.remove(filename)
+            return
+        
+        # Arquivo gerado por completo (erros de escrita são propagados pelo
+        # save): checkpoints não são mais necessários, a menos que alguma
+        # conversa tenha falhado (--resume busca de novo só essas)
+        failed_count = len(self.failed_conversations)
+        if self.checkpoint and not failed_count:
+            self.clear_checkpoints()
         
-        # Estatísticas finais
-        elapsed_time = time.time() - start_time
         # Estatísticas finais
         elapsed_time = time.time() - start_time
         self._log("")
@@ -661,10 +1442,15 @@ class ChatwootETL:
         self._log("=" * 60)
         self._log(f"⏱️  Tempo total: {elapsed_time:.2f} segundos")
         self._log(f"💬 Conversas processadas: {len(conversations)}")
-        self._log(f"📨 Mensagens extraídas: {len(transformed_data)}")
-        self._log(f"📁 Arquivo gerado: chatwoot_history_dump.json")
+        self._log(f"📨 Mensagens extraídas: {message_count}")
+        self._log(f"📁 Arquivo gerado: {filename}")
         self._log("")
-        self._log("✅ ETL concluído com sucesso!")
+        if failed_count:
+            self._log(f"⚠️  ETL concluído com {failed_count} conversa(s) sem mensagens (falha na API)")
+            if self.checkpoint:
+                self._log("   Checkpoints mantidos: rode novamente com --resume (com as mesmas datas) para tentar de novo")
+        else:
+            self._log("✅ ETL concluído com sucesso!")
         self._log("=" * 60)
 
 
@@ -674,20 +1460,29 @@ def main():
     parser = argparse.ArgumentParser(description='Chatwoot ETL Extract')
     parser.add_argument('--start-date', type=str, help='Data inicial (YYYY-MM-DD)')
     parser.add_argument('--end-date', type=str, help='Data final (YYYY-MM-DD)')
+    parser.add_argument('--format', choices=list(OUTPUT_EXTENSIONS), default='json',
+                        help='Formato do arquivo de saída (parquet requer pyarrow)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Retoma uma extração interrompida a partir do checkpoint')
     
     args = parser.parse_args()
 
     try:
         etl = ChatwootETL(start_date=args.start_date, end_date=args.end_date)
+        etl.output_format = args.format
+        etl.checkpoint = True
+        etl.resume = args.resume
         etl.run()
-    except ValueError as e:
+    except (ValueError, ImportError) as e:
         print(str(e))
     except KeyboardInterrupt:
         print("\n\n⚠️  Processo interrompido pelo usuário")
+        print("   Para continuar de onde parou: python chatwoot_etl.py --resume (com as mesmas datas)")
     except Exception as e:
         print(f"\n❌ Erro inesperado: {str(e)}")
         import traceback
         traceback.print_exc()
+        print("   Para continuar de onde parou: python chatwoot_etl.py --resume (com as mesmas datas)")
 
 
 if __name__ == "__main__":
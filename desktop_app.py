@@ -11,18 +11,20 @@ if sys.stderr is None:
     sys.stderr = NullWriter()
 
 import os
-import json
+import re
+import time
+import traceback
 from datetime import datetime
+from pathlib import Path
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                              QHBoxLayout, QLabel, QPushButton, QDateEdit, 
                              QListWidget, QListWidgetItem, QProgressBar, 
-                             QMessageBox, QFrame, QAbstractItemView, QFileDialog)
-from PyQt6.QtCore import Qt, QThread, pyqtSignal, QDate
-from PyQt6.QtGui import QIcon, QFont, QColor, QPalette
+                             QMessageBox, QFrame, QAbstractItemView, QCheckBox)
+from PyQt6.QtCore import Qt, QObject, QThread, QTimer, QUrl, pyqtSignal, pyqtSlot, QDate
+from PyQt6.QtGui import QDesktopServices
 
-from chatwoot_etl import ChatwootETL
+from chatwoot_etl import ChatwootETL, ExtractionCancelled, compression_suffix
 
-# --- Configuração de Estilo (Tema Bronze/Escuro) ---
 # --- Configuração de Estilo (Tema Bronze/Escuro) ---
 STYLESHEET = """
 QMainWindow {
@@ -132,46 +134,124 @@ QProgressBar::chunk {
 }
 """
 
-class WorkerThread(QThread):
+# Minificado uma vez no import (sem comentários e espaços extras): o parser
+# de QSS do Qt processa menos texto em setStyleSheet
+STYLESHEET = re.sub(r"/\*.*?\*/", "", STYLESHEET, flags=re.S)
+STYLESHEET = re.sub(r"\s+", " ", STYLESHEET).strip()
+
+class EtlWorker(QObject):
+    """
+    Executa as operações do ETL fora da thread da interface
+    
+    Vive em uma única QThread criada com a janela: carregar canais e
+    extrair chegam como sinais (fila de eventos da thread), sem criar e
+    destruir uma thread a cada operação.
+    """
     progress_updated = pyqtSignal(int, str)
     finished = pyqtSignal(str, int, int) # filename, num_conversations, num_messages
     error_occurred = pyqtSignal(str)
+    channels_loaded = pyqtSignal(dict)
+
+    # Intervalo mínimo (s) entre atualizações com o mesmo percentual
+    PROGRESS_MIN_INTERVAL = 0.2
 
-    def __init__(self, start_date, end_date, selected_ids, all_dates=False):
+    def __init__(self):
         super().__init__()
-        self.start_date = start_date
-        self.end_date = end_date
-        self.selected_ids = selected_ids
-        self.all_dates = all_dates
+        self._last_percent = -1
+        self._last_emit = 0.0
+        self._etl = None  # ETL da extração em andamento (para cancel)
+
+    def cancel(self):
+        """
+        Cancela a extração em andamento (chamado direto da thread da
+        interface, não por sinal: a thread do worker está ocupada)
+        """
+        etl = self._etl
+        if etl is not None:
+            etl.cancel()
+
+    def _report_progress(self, percent, message):
+        """
+        Callback de progresso do ETL: só repassa para a interface quando o
+        percentual muda ou após PROGRESS_MIN_INTERVAL, evitando inundar o
+        loop de eventos do Qt com sinais entre threads
+        """
+        now = time.monotonic()
+        if percent == self._last_percent and now - self._last_emit < self.PROGRESS_MIN_INTERVAL:
+            return
+        self._last_percent = percent
+        self._last_emit = now
+        self.progress_updated.emit(percent, message)
 
-    def run(self):
+    @pyqtSlot(bool)
+    def load_channels(self, use_cache=True):
+        try:
+            with ChatwootETL() as etl:
+                if etl.load_inbox_map(use_cache=use_cache):
+                    self.channels_loaded.emit(etl.inbox_map)
+                else:
+                    self.channels_loaded.emit({})
+        except:
+            self.channels_loaded.emit({})
+
+    @pyqtSlot(dict)
+    def extract(self, params):
+        """
+        Extrai as conversas e grava o arquivo de saída
+        
+        Args:
+            params: start_date/end_date (YYYY-MM-DD), selected_ids (inboxes;
+                vazio = todos), all_dates (ignora as datas), compress e
+                export_dir (Path da pasta de saída, criada se não existir) e inbox_map
+                (mapa já carregado; se vazio, o worker carrega)
+        """
+        start_date = params.get('start_date')
+        end_date = params.get('end_date')
+        selected_ids = frozenset(params.get('selected_ids') or ())
+        all_dates = params.get('all_dates', False)
+        compress = params.get('compress', False)
+        export_dir = params['export_dir']
+        inbox_map = params.get('inbox_map')
+        
+        self._last_percent = -1
+        
+        etl = None
+        full_path = None
         try:
             # Configura datas (None se for tudo)
-            s_date = None if self.all_dates else self.start_date
-            e_date = None if self.all_dates else self.end_date
+            s_date = None if all_dates else start_date
+            e_date = None if all_dates else end_date
             
             # Instancia ETL passando o callback de progresso
             # A função de callback deve ter a assinatura (percent, message)
             etl = ChatwootETL(
                 start_date=s_date, 
                 end_date=e_date, 
-                progress_callback=self.progress_updated.emit
+                progress_callback=self._report_progress
             )
+            self._etl = etl
             
-            # Carrega mapa
-            # O ETL agora reporta o progresso internamente, mas podemos fazer um sanity check
-            if not etl.load_inbox_map():
+            # Carrega mapa: reaproveita o que a janela já carregou para a
+            # lista de canais; senão o ETL carrega (e reporta o progresso)
+            if inbox_map:
+                etl.inbox_map = dict(inbox_map)
+            elif not etl.load_inbox_map():
                  raise Exception("Falha ao carregar canais do Chatwoot.")
 
             # Busca Conversas
             self.progress_updated.emit(20, "Buscando conversas...")
             conversations = []
             
+            # Todos os canais selecionados equivale a "Todos os Canais": usa a
+            # listagem global em vez de uma busca por inbox
+            if selected_ids and selected_ids >= etl.inbox_map.keys():
+                selected_ids = frozenset()
+            
             # Lógica de seleção de inboxes específica
-            if not self.selected_ids:
+            if not selected_ids:
                 conversations = etl.get_all_conversations()
             else:
-                filtered_map = {k: v for k, v in etl.inbox_map.items() if k in self.selected_ids}
+                filtered_map = {k: etl.inbox_map[k] for k in selected_ids if k in etl.inbox_map}
                 if filtered_map:
                     etl.inbox_map = filtered_map
                     conversations = etl._get_conversations_by_inbox()
@@ -188,41 +268,77 @@ class WorkerThread(QThread):
             # Como passamos start_date=None para o ETL se all_dates=True, ele já sabe o que fazer.
             conversations = etl.filter_conversations_by_date(conversations)
 
-            # Transformação (ETL agora reporta progresso detalhado aqui)
-            transformed_data = etl.transform_messages(conversations)
-
             # Salvando
-            export_dir = os.path.join(os.getcwd(), 'exports')
-            os.makedirs(export_dir, exist_ok=True)
-            
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             
-            if self.all_dates:
+            if all_dates:
                 period_str = "historico_completo"
             else:
                 s_s = etl.start_date.strftime("%d-%m-%Y") if etl.start_date else "inicio"
                 e_s = etl.end_date.strftime("%d-%m-%Y") if etl.end_date else "fim"
                 period_str = f"{s_s}_a_{e_s}"
             
-            filename = f"chatwoot_{period_str}_{timestamp}.json"
-            full_path = os.path.join(export_dir, filename)
+            # JSON Lines: um registro por linha, gravado conforme cada
+            # conversa é processada (sem lista em memória nem array envolvendo)
+            filename = f"chatwoot_{period_str}_{timestamp}.jsonl"
+            if compress:
+                filename += compression_suffix()
+            export_dir.mkdir(parents=True, exist_ok=True)
+            full_path = str(export_dir / filename)
             
-            etl.save_to_json(transformed_data, full_path)
+            # O ETL escolhe o formato (e a compactação) pela extensão e
+            # reporta progresso detalhado durante a iteração; uma falha de
+            # escrita é propagada e cai no error_occurred (arquivo incompleto)
+            total_messages = etl.save(etl.iter_messages(conversations), full_path)
             
             self.progress_updated.emit(100, "Concluído!")
-            self.finished.emit(full_path, len(conversations), len(transformed_data))
+            self.finished.emit(full_path, len(conversations), total_messages)
             
+        except ExtractionCancelled:
+            # Janela fechando: só descarta o arquivo incompleto
+            if full_path and os.path.exists(full_path):
+                os.remove(full_path)
         except Exception as e:
-            import traceback
-            traceback.print_exc()
-            self.error_occurred.emit(str(e))
-
-from PyQt6.QtWidgets import QCheckBox, QSpacerItem, QSizePolicy
+            # O trace vai junto na mensagem de erro (em modo windowed não há console)
+            self.error_occurred.emit(f"{e}\n\n{traceback.format_exc()}")
+        finally:
+            self._etl = None
+            if etl is not None:
+                etl.close()
 
 class ChatwootApp(QMainWindow):
+    # Pedidos para o EtlWorker (entregues na thread dele)
+    load_channels_requested = pyqtSignal(bool)
+    extract_requested = pyqtSignal(dict)
+
+    # Espera máxima (ms) pela thread do worker ao fechar a janela
+    CLOSE_WAIT_MS = 5000
+
     def __init__(self):
         super().__init__()
-        self.worker = None
+        
+        # Worker único em uma thread de longa duração
+        self.worker_thread = QThread(self)
+        self.worker = EtlWorker()
+        self.worker.moveToThread(self.worker_thread)
+        self.worker_thread.finished.connect(self.worker.deleteLater)
+        
+        self.load_channels_requested.connect(self.worker.load_channels)
+        self.extract_requested.connect(self.worker.extract)
+        self.worker.channels_loaded.connect(self.on_channels_loaded)
+        self.worker.progress_updated.connect(self.update_progress)
+        self.worker.finished.connect(self.extraction_finished)
+        self.worker.error_occurred.connect(self.extraction_error)
+        
+        self.worker_thread.start()
+        self._loaded_once = False
+        self._extracting = False
+        self.inbox_map = {}  # Canais carregados (inbox_id -> nome)
+        
+        # Pasta de saída resolvida uma vez (não muda se o cwd mudar depois);
+        # criada pelo worker na extração, onde uma falha vira diálogo de erro
+        self.export_dir = Path.cwd() / 'exports'
+        
         self.initUI()
         
     def initUI(self):
@@ -249,6 +365,9 @@ class ChatwootApp(QMainWindow):
         config_layout = QVBoxLayout(config_card)
         config_layout.setSpacing(15)
         main_layout.addWidget(config_card)
+        
+        # Controles bloqueados durante a extração (ver set_interactive)
+        self.interactive_root = config_card
 
         # 1. Seção de Datas
         date_header_layout = QHBoxLayout()
@@ -269,15 +388,18 @@ class ChatwootApp(QMainWindow):
         date_row = QHBoxLayout(self.date_container)
         date_row.setContentsMargins(0,0,0,0)
         
+        # Período padrão: últimos 7 dias
+        today = QDate.currentDate()
+        
         self.start_date_edit = QDateEdit()
         self.start_date_edit.setCalendarPopup(True)
-        self.start_date_edit.setDate(QDate.currentDate().addDays(-7))
+        self.start_date_edit.setDate(today.addDays(-7))
         self.start_date_edit.setDisplayFormat("dd/MM/yyyy")
         self.start_date_edit.setMinimumWidth(150)
         
         self.end_date_edit = QDateEdit()
         self.end_date_edit.setCalendarPopup(True)
-        self.end_date_edit.setDate(QDate.currentDate())
+        self.end_date_edit.setDate(today)
         self.end_date_edit.setDisplayFormat("dd/MM/yyyy")
         self.end_date_edit.setMinimumWidth(150)
         
@@ -308,15 +430,21 @@ class ChatwootApp(QMainWindow):
         
         self.channel_list = QListWidget()
         self.channel_list.setSelectionMode(QAbstractItemView.SelectionMode.MultiSelection)
+        self.channel_list.setUniformItemSizes(True)  # Itens de uma linha: dispensa medir cada um
         self.channel_list.setFixedHeight(180)
         config_layout.addWidget(self.channel_list)
         
         self.refresh_btn = QPushButton("🔄 Atualizar Lista")
         self.refresh_btn.setFixedWidth(180)
         self.refresh_btn.setCursor(Qt.CursorShape.PointingHandCursor)
-        self.refresh_btn.clicked.connect(self.load_channels)
+        self.refresh_btn.clicked.connect(self.refresh_channels)
         config_layout.addWidget(self.refresh_btn, alignment=Qt.AlignmentFlag.AlignRight)
 
+        # 3. Compactação do arquivo (zstd, ou gzip se o zstandard não estiver instalado)
+        self.compress_cb = QCheckBox(f"Compactar arquivo (.jsonl{compression_suffix()})")
+        self.compress_cb.setCursor(Qt.CursorShape.PointingHandCursor)
+        config_layout.addWidget(self.compress_cb)
+
         # --- Ações ---
         main_layout.addStretch()
         
@@ -348,8 +476,11 @@ class ChatwootApp(QMainWindow):
         
     def showEvent(self, event):
         super().showEvent(event)
-        QThread.msleep(100)
-        self.load_channels()
+        # Carrega os canais só na primeira exibição (não ao restaurar a janela),
+        # depois que o loop de eventos pintar a janela
+        if not self._loaded_once:
+            self._loaded_once = True
+            QTimer.singleShot(0, self.load_channels)
         
     def toggle_dates(self, checked):
         self.date_container.setEnabled(not checked)
@@ -359,18 +490,21 @@ class ChatwootApp(QMainWindow):
         if checked:
             self.channel_list.clearSelection()
 
-    def load_channels(self):
+    def refresh_channels(self):
+        # Botão "Atualizar Lista": ignora o cache de canais e consulta a API
+        self.load_channels(use_cache=False)
+
+    def load_channels(self, use_cache=True):
         self.channel_list.clear()
         self.channel_list.addItem("Conectando ao Chatwoot...")
         self.channel_list.setEnabled(False)
         self.refresh_btn.setEnabled(False)
         self.all_channels_cb.setEnabled(False)
         
-        self.loader_thread = LoadChannelsThread()
-        self.loader_thread.finished.connect(self.on_channels_loaded)
-        self.loader_thread.start()
+        self.load_channels_requested.emit(use_cache)
 
     def on_channels_loaded(self, channels):
+        self.inbox_map = channels  # Reaproveitado pela extração
         self.channel_list.clear()
         self.channel_list.setEnabled(not self.all_channels_cb.isChecked())
         self.refresh_btn.setEnabled(True)
@@ -380,33 +514,29 @@ class ChatwootApp(QMainWindow):
             self.channel_list.addItem("Nenhum canal encontrado.")
             return
 
-        for cid, name in channels.items():
-            item = QListWidgetItem(f"{name} (ID: {cid})")
-            item.setData(Qt.ItemDataRole.UserRole, cid)
-            self.channel_list.addItem(item)
+        # Inserção em lote: sem repintar nem emitir sinais a cada item
+        self.channel_list.setUpdatesEnabled(False)
+        self.channel_list.blockSignals(True)
+        try:
+            for cid, name in channels.items():
+                item = QListWidgetItem(f"{name} (ID: {cid})")
+                item.setData(Qt.ItemDataRole.UserRole, cid)
+                self.channel_list.addItem(item)
+        finally:
+            self.channel_list.blockSignals(False)
+            self.channel_list.setUpdatesEnabled(True)
             
         self.status_label.setText("Canais carregados.")
 
     def start_extraction(self):
-        # Parâmetros
-        s_date = self.start_date_edit.text() # ex: 12/12/2025
-        e_date = self.end_date_edit.text()
-        
-        # Conversão de formato brasileiro DD/MM/YYYY -> YYYY-MM-DD para o Worker/ETL
-        # O Worker espera YYYY-MM-DD
-        try:
-            if not self.all_dates_cb.isChecked():
-                d_start = datetime.strptime(s_date, "%d/%m/%Y")
-                d_end = datetime.strptime(e_date, "%d/%m/%Y")
-                
-                s_date_iso = d_start.strftime("%Y-%m-%d")
-                e_date_iso = d_end.strftime("%Y-%m-%d")
-            else:
-                s_date_iso = None
-                e_date_iso = None
-        except ValueError:
-            QMessageBox.warning(self, "Erro", "Formato de data inválido.")
-            return
+        # Parâmetros: o Worker/ETL espera YYYY-MM-DD; lê o QDate direto
+        # (o widget só aceita datas válidas, sem depender do texto exibido)
+        if not self.all_dates_cb.isChecked():
+            s_date_iso = self.start_date_edit.date().toString(Qt.DateFormat.ISODate)
+            e_date_iso = self.end_date_edit.date().toString(Qt.DateFormat.ISODate)
+        else:
+            s_date_iso = None
+            e_date_iso = None
 
         selected_ids = []
         if not self.all_channels_cb.isChecked():
@@ -418,21 +548,20 @@ class ChatwootApp(QMainWindow):
                 return
         
         # Bloqueia UI
-        self.extract_btn.setEnabled(False)
-        self.refresh_btn.setEnabled(False)
-        self.channel_list.setEnabled(False)
-        self.all_channels_cb.setEnabled(False)
-        self.start_date_edit.setEnabled(False)
-        self.end_date_edit.setEnabled(False)
-        self.all_dates_cb.setEnabled(False)
+        self.set_interactive(False)
+        self._extracting = True
         self.progress_bar.setValue(0)
         
-        # Inicia Worker
-        self.worker = WorkerThread(s_date_iso, e_date_iso, selected_ids, all_dates=self.all_dates_cb.isChecked())
-        self.worker.progress_updated.connect(self.update_progress)
-        self.worker.finished.connect(self.extraction_finished)
-        self.worker.error_occurred.connect(self.extraction_error)
-        self.worker.start()
+        # Inicia a extração no worker
+        self.extract_requested.emit({
+            'start_date': s_date_iso,
+            'end_date': e_date_iso,
+            'selected_ids': selected_ids,
+            'all_dates': self.all_dates_cb.isChecked(),
+            'compress': self.compress_cb.isChecked(),
+            'export_dir': self.export_dir,
+            'inbox_map': self.inbox_map,
+        })
         
     def update_progress(self, val, text):
         self.progress_bar.setValue(val)
@@ -445,7 +574,9 @@ class ChatwootApp(QMainWindow):
         if filename:
             msg = f"Extração concluída!\n\nArquivo: {os.path.basename(filename)}\nConversas: {n_conv}\nMensagens: {n_msgs}"
             QMessageBox.information(self, "Sucesso", msg)
-            os.startfile(os.path.dirname(filename))
+            # Abre a pasta pelo sistema (multiplataforma), depois que o diálogo fechar
+            folder_url = QUrl.fromLocalFile(os.path.dirname(filename))
+            QTimer.singleShot(0, lambda: QDesktopServices.openUrl(folder_url))
         else:
             QMessageBox.warning(self, "Aviso", "Nenhum dado encontrado.")
 
@@ -453,29 +584,41 @@ class ChatwootApp(QMainWindow):
         self.reset_ui()
         QMessageBox.critical(self, "Erro", f"Ocorreu um erro:\n{error_msg}")
 
+    def set_interactive(self, enabled):
+        # Desabilitar o card propaga para todos os controles dele de uma vez;
+        # ao reabilitar, cada um volta ao próprio estado (ex: datas desabilitadas
+        # por "Histórico Completo", lista desabilitada por "Todos os Canais")
+        self.interactive_root.setEnabled(enabled)
+        self.extract_btn.setEnabled(enabled)
+
     def reset_ui(self):
-        self.extract_btn.setEnabled(True)
-        self.refresh_btn.setEnabled(True)
-        self.all_channels_cb.setEnabled(True)
-        self.all_dates_cb.setEnabled(True)
-        
-        self.toggle_dates(self.all_dates_cb.isChecked())
-        self.toggle_channels(self.all_channels_cb.isChecked())
-        
+        self._extracting = False
+        self.set_interactive(True)
         self.status_label.setText("Pronto.")
 
-class LoadChannelsThread(QThread):
-    finished = pyqtSignal(dict)
-    
-    def run(self):
-        try:
-            etl = ChatwootETL()
-            if etl.load_inbox_map():
-                self.finished.emit(etl.inbox_map)
-            else:
-                self.finished.emit({})
-        except:
-            self.finished.emit({})
+    def closeEvent(self, event):
+        # Extração em andamento: confirma e pede o cancelamento ao ETL
+        if self._extracting:
+            answer = QMessageBox.question(
+                self, "Extração em andamento",
+                "Uma extração está em andamento. Deseja cancelá-la e sair?"
+            )
+            if answer != QMessageBox.StandardButton.Yes:
+                event.ignore()
+                return
+            self.worker.cancel()
+        
+        # Encerra a thread do worker com espera limitada (a interface não trava)
+        self.worker_thread.quit()
+        if not self.worker_thread.wait(self.CLOSE_WAIT_MS):
+            # Requisição ainda em curso (termina pelo timeout dela): esconde a
+            # janela e encerra o app quando a thread terminar
+            self.worker_thread.finished.connect(QApplication.quit)
+            if not self.worker_thread.isFinished():
+                self.hide()
+                event.ignore()
+                return
+        super().closeEvent(event)
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)